@@ -2,14 +2,20 @@
 # -*- coding: utf-8 -*-
 '''A simple script to setup dataset files
 '''
-import re
+import io
+import os
 import sys
 import requests
 import hashlib
+import json
 import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+from itertools import chain
+from scipy.sparse import csr_matrix
 from pathlib import Path
-from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.datasets import load_svmlight_file, dump_svmlight_file
 
 def parse_data(filename):
@@ -20,14 +26,21 @@ def parse_data(filename):
     features, labels : numpy.ndarrays
     '''
     with open(filename, "rb") as f:
-        infoline = f.readline()
-        infoline = re.sub(r"^b'", "", str(infoline))
-        n_features = int(re.sub(r"^\d+\s(\d+)\s\d+.*$", r"\1", infoline))
+        # infoline: n_samples n_features n_labels
+        n_features = int(f.readline().split()[1])
         features, labels = load_svmlight_file(f, n_features=n_features, multilabel=True)
-    mlb = MultiLabelBinarizer()
-    labels = mlb.fit_transform(labels)
-    features = np.array(features.todense())
-    features = np.ascontiguousarray(features)
+    # binarize labels straight into a sparse indicator matrix; columns are the
+    # sorted labels that actually occur, same as MultiLabelBinarizer
+    row_ptr = np.cumsum([0] + [len(row) for row in labels])
+    flat = np.fromiter(chain.from_iterable(labels), dtype=np.float64, count=row_ptr[-1])
+    classes, col_idx = np.unique(flat, return_inverse=True)
+    labels = csr_matrix((np.ones(len(col_idx), dtype=np.int64), col_idx, row_ptr),
+                        shape=(len(row_ptr)-1, len(classes)))
+    # a label repeated within a row is still a single 1, not a count
+    labels.sum_duplicates()
+    labels.data[:] = 1
+    labels = labels.toarray()
+    features = features.toarray(order='C')
     return features, labels
 
 def get_data_path():
@@ -51,15 +64,20 @@ def get_data_path():
 
 def download_data(redownload=False):
     '''Helper function to download files from Google Drive to Github/data/.
-    - downloads datasets
+    - downloads datasets concurrently
     - checks md5
-    - extracts dataset
+    - extracts only the needed dataset files, straight to data/
     - preprocesses EURLex4k & MediamillReduced to proper formats
-    - moves and renames files
-    - cleans up data directory
+    - caches validated zips in data/.cache/ & records extracted datasets in
+      data/.manifest.json so reruns skip them
     
     redownload : boolean, default=False 
-        redownloads and overwrites datasets; useful if they get corrupted
+        ignores the manifest & cache, redownloads and overwrites datasets; 
+        useful if they get corrupted. Without it, a dataset is re-extracted
+        whenever its txt no longer matches the mtime & size in the manifest
+    
+    Set the environment variable SETUP_VERIFY=1 to re-parse MediamillReduced
+    after writing it & check its labels round-trip (slow; off by default).
     
     Returns
     -------
@@ -72,20 +90,35 @@ def download_data(redownload=False):
                 return value
         return None
     
-    # save chunked files correctly
+    # file wrapper that hashes every chunk on its way to disk
+    class HashingWriter:
+        def __init__(self, f):
+            self.f = f
+            self.md5 = hashlib.md5()
+        
+        def write(self, chunk):
+            self.md5.update(chunk)
+            return self.f.write(chunk)
+    
+    # stream the raw socket straight to disk, hashing each chunk as it goes
     def save_response_content(response, destination):
-        CHUNK_SIZE = 32768
-        with open(destination, "wb") as f:
-            for chunk in response.iter_content(CHUNK_SIZE):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
+        CHUNK_SIZE = 1 << 20
+        response.raw.decode_content = True # undo any transfer gzip
+        with open(destination, "wb", buffering=CHUNK_SIZE) as f:
+            writer = HashingWriter(f)
+            shutil.copyfileobj(response.raw, writer, length=CHUNK_SIZE)
+        return writer.md5.hexdigest()
     
-    # verify downloaded file checksum
+    # verify a previously cached zip without loading it all into memory
     def check_md5(file, checksum):
-        m = hashlib.md5()
-        with open(file, 'rb') as f:
-            data = f.read()
-            m.update(data)
+        CHUNK_SIZE = 1 << 20
+        with open(file, 'rb', buffering=CHUNK_SIZE) as f:
+            if hasattr(hashlib, 'file_digest'): # python 3.11+
+                m = hashlib.file_digest(f, 'md5')
+            else:
+                m = hashlib.md5()
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    m.update(chunk)
         return m.hexdigest() == checksum
     
     url = "https://docs.google.com/uc?export=download"
@@ -97,46 +130,107 @@ def download_data(redownload=False):
            'Eurlex'   : ('0B3lPMIHmG6vGU0VTR1pCejFpWjg', 'ec8feb2a9a0bd0f32d8f4c2b00725524')}
 
     git_data = get_data_path()
-    session  = requests.Session()
     
-    for k,v in ids.items():
-        # do nothing if the dataset already exists and we don't want to redownload
-        if Path(git_data+f'{k}_data.txt').exists() and (redownload==False):
-            print(f'Skipping: {k}, dataset already exists')
-            continue
-        
-        print(f'Downloading: {k}')
-        response = session.get(url, params = {'id': v[0]}, stream=True)
-        token = get_confirm_token(response)
+    # validated zips are kept here so a deleted dataset can be re-extracted offline
+    cache_dir = git_data + '.cache/'
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
     
-        if token:
-            params = {'id': v[0], 'confirm': token}
-            response = session.get(url, params=params, stream=True)
+    # manifest of extracted dataset files: {name: {'md5':..., 'mtime':..., 'size':...}}
+    # a txt is only trusted while its mtime & size still match what was recorded
+    manifest_file = git_data + '.manifest.json'
+    manifest = dict()
+    if Path(manifest_file).exists():
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    manifest_lock = threading.Lock()
     
-        dataset_zip = git_data+k+'.zip'
-        save_response_content(response, dataset_zip)
-        assert check_md5(dataset_zip, v[1]), f'{k} download failed md5'
-        
-        # unzip
-        shutil.unpack_archive(dataset_zip, git_data)
+    # workers print concurrently; one lock & flush per message keeps lines whole
+    print_lock = threading.Lock()
+    def log(message):
+        with print_lock:
+            print(message, flush=True)
+    
+    # record a dataset txt as it is on disk right now; the manifest itself is replaced atomically
+    def record_dataset(k, md5_checksum):
+        stat = Path(git_data+f'{k}_data.txt').stat()
+        with manifest_lock:
+            manifest[k] = {'md5': md5_checksum, 'mtime': stat.st_mtime, 'size': stat.st_size}
+            with open(manifest_file+'.part', 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(manifest_file+'.part', manifest_file)
+    
+    # download, verify & extract a single dataset; runs in its own thread
+    def fetch_dataset(k, google_id, md5_checksum):
+        dataset_zip = cache_dir+k+'.zip'
         
-        # extract datasets & cleanup
-        if k=='Eurlex':
-            with open(git_data+f'{k}_data.txt', 'w') as outfile:
-                # write manual header
-                outfile.write(f'{15539+3809} 5000 3993\n')
-                for fname in ['eurlex_train.txt', 'eurlex_test.txt']:
-                    with open(git_data+f'{k}/'+fname) as infile:
-                        # skip header
-                        next(infile)
-                        for line in infile:
-                            outfile.write(line)
+        # reuse the cached zip unless it's missing, corrupt, or we want to redownload
+        if Path(dataset_zip).exists() and (redownload==False) and check_md5(dataset_zip, md5_checksum):
+            log(f'Extracting: {k}, from cached download')
         else:
-            dataset = git_data + k + f'/{k}_data.txt'
-            shutil.copy(dataset, git_data)
-        shutil.rmtree(git_data+k)
-        Path(dataset_zip).unlink()
-        print(f'{k} dataset extracted & excess files removed')
+            # requests sessions aren't safe to share across threads
+            session = requests.Session()
+            
+            log(f'Downloading: {k}')
+            response = session.get(url, params = {'id': google_id}, stream=True)
+            token = get_confirm_token(response)
+        
+            if token:
+                params = {'id': google_id, 'confirm': token}
+                response = session.get(url, params=params, stream=True)
+        
+            checksum = save_response_content(response, dataset_zip)
+            if checksum != md5_checksum:
+                Path(dataset_zip).unlink()
+                raise AssertionError(f'{k} download failed md5')
+        
+        # extract only the dataset files we need; written to a temp file & renamed into
+        # place once complete, so an interrupted run never leaves a partial txt behind
+        CHUNK_SIZE = 1 << 20
+        dataset_txt = git_data+f'{k}_data.txt'
+        with zipfile.ZipFile(dataset_zip) as z:
+            if k=='Eurlex':
+                # text mode on both ends, so line endings are normalised exactly as before
+                with open(dataset_txt+'.part', 'w') as outfile:
+                    # write manual header
+                    outfile.write(f'{15539+3809} 5000 3993\n')
+                    for fname in ['eurlex_train.txt', 'eurlex_test.txt']:
+                        with io.TextIOWrapper(z.open(f'{k}/'+fname), newline=None) as infile:
+                            # skip header, then block copy the rest
+                            next(infile)
+                            shutil.copyfileobj(infile, outfile, length=CHUNK_SIZE)
+            else:
+                with z.open(f'{k}/{k}_data.txt') as src, open(dataset_txt+'.part', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, length=CHUNK_SIZE)
+        os.replace(dataset_txt+'.part', dataset_txt)
+        log(f'{k} dataset extracted')
+        
+        # record the extracted dataset so reruns can skip it entirely
+        record_dataset(k, md5_checksum)
+    
+    # downloads are network bound, so fetch all datasets concurrently
+    with ThreadPoolExecutor(max_workers=len(ids)) as executor:
+        futures = list()
+        for k,v in ids.items():
+            # do nothing if the dataset is unchanged since it was extracted and we don't want to redownload
+            dataset_txt = Path(git_data+f'{k}_data.txt')
+            if dataset_txt.exists() and (redownload==False):
+                stat = dataset_txt.stat()
+                entry = manifest.get(k)
+                if entry is None:
+                    # extracted before the manifest existed; trust it & start tracking it
+                    record_dataset(k, v[1])
+                    log(f'Skipping: {k}, dataset already exists')
+                    continue
+                if (entry.get('md5'), entry.get('mtime'), entry.get('size'))==(v[1], stat.st_mtime, stat.st_size):
+                    log(f'Skipping: {k}, dataset already exists')
+                    continue
+                log(f'{k} dataset changed since it was extracted')
+            futures.append(executor.submit(fetch_dataset, k, *v))
+        
+        # re-raise the first failure (e.g. an md5 mismatch); the pool still lets the
+        # other in-flight downloads finish before the error leaves this block
+        for future in as_completed(futures):
+            future.result()
         
     # if MediamillReduced doesn't exist, or you want to 'redownload' it
     filename = git_data+f'MediamillReduced_data.txt'
@@ -145,19 +239,21 @@ def download_data(redownload=False):
         features, y = parse_data(git_data+'Mediamill_data.txt')
         # create MediamillReduced from Mediamill by removing 5 most common lables
         idx = np.argpartition(y.sum(axis=0), -5)[-5:]
-        _y  = np.delete(y, idx, axis=1)
-        
-        # save in svmlight format
-        dump_svmlight_file(features, _y, filename, multilabel=True)
+        keep = np.ones(y.shape[1], dtype=bool)
+        keep[idx] = False
+        # slice sparse labels; dump_svmlight_file takes them without a dense copy
+        _y  = csr_matrix(y)[:, keep]
         
-        # prepend infoline to keep same format across datasets
+        # save in svmlight format, led by an infoline to keep same format across datasets
         infoline = f'{features.shape[0]} {features.shape[1]} {_y.shape[1]}\n'
-        with open(filename, 'r') as original: data = original.read()
-        with open(filename, 'w') as modified: modified.write(infoline + data)
+        with open(filename, 'wb') as f:
+            f.write(infoline.encode())
+            dump_svmlight_file(features, _y, f, multilabel=True)
         
-        # verify the file saved correctly
-        features, y = parse_data("../data/MediamillReduced_data.txt")
-        assert np.array_equal(_y, y), 'MediamillReduced_data.txt saved incorrectly'
+        # verify the file saved correctly; a full re-parse, so only on request
+        if os.environ.get('SETUP_VERIFY', '') not in ('', '0'):
+            features, y = parse_data(filename)
+            assert np.array_equal(_y.toarray(), y), 'MediamillReduced_data.txt saved incorrectly'
     else:
         print('Skipping: MediamillReduced, dataset already exists')
 
@@ -173,13 +269,14 @@ def test_contextualbandits():
 def main(args=None):
     print(f'storing data to: {get_data_path()}')
     # sloppy argument handling; redownload=True if 'redownload' appears in sysargs
-    download_data(redownload=np.any(['redownload' in x for x in args]))
+    download_data(redownload=any('redownload' in x for x in args))
     test_contextualbandits()
     
 if __name__ == "__main__":
     args = sys.argv
     # sloppy argument handling for help: @TODO - correctly handle sysargs
-    if np.any(['h' in x for x in args]):
-        print("to redownload and overwrite your datasets, use:\n    python setup.py redownload")
+    if any('h' in x for x in args):
+        print("to redownload and overwrite your datasets, use:\n    python setup.py redownload\n"
+              "to also verify MediamillReduced after creating it, use:\n    SETUP_VERIFY=1 python setup.py")
     else:
         main(args)
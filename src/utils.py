@@ -1,50 +1,69 @@
 from tqdm.auto import tqdm
 import os
+import time
+from functools import lru_cache
 import numpy as np
-import pandas as pd
 random_seed=23
 
-# rounds are simulated from the full dataset
-def simulate_rounds(model, rewards, actions_hist, ttime, X_global, y_global, batch_st, batch_end, fit=True):
-    start = pd.Timestamp.now()
+# rewards for (row, action) pairs; with <=64 labels each row's labels are packed into one uint64,
+# turning the 2-D gather on y into a 1-D gather plus a shift
+def lookup_rewards(y_global, y_packed, rows, batch_st, batch_end, actions):
+    if y_packed is None:
+        return y_global[rows[batch_st:batch_end], actions]
+    return ((y_packed[batch_st:batch_end] >> actions.astype(np.uint64)) & 1).astype(y_global.dtype)
+
+
+# rounds are simulated from the full dataset; X_seen is the X[:batch_end] view shared by all models
+# & rows is np.arange(len(X)), both built by the caller
+def simulate_rounds(model, rewards, actions_hist, ttime, X_seen, y_global, rows, batch_st, batch_end, fit=True,
+                    y_packed=None):
+    start = time.perf_counter()
     
     np.random.seed(batch_st)
     
     ## choosing actions for this batch
-    actions_this_batch = model.predict(X_global[batch_st:batch_end, :]).astype('uint8')
+    actions_this_batch = model.predict(X_seen[batch_st:]).astype('uint8')
     
     # keeping track of the sum of rewards received
-    rewards.append(y_global[np.arange(batch_st, batch_end), actions_this_batch].sum())
+    rewards.append(lookup_rewards(y_global, y_packed, rows, batch_st, batch_end, actions_this_batch).sum())
     
-    # adding this batch to the history of selected actions
-    new_actions_hist = np.append(actions_hist, actions_this_batch)
+    # adding this batch to the (preallocated) history of selected actions
+    actions_hist[batch_st:batch_end] = actions_this_batch
+    new_actions_hist = actions_hist[:batch_end]
     
     # now refitting the algorithms after observing these new rewards
     np.random.seed(random_seed)
     if fit:
-        model.fit(X_global[:batch_end, :], new_actions_hist, y_global[np.arange(batch_end), new_actions_hist],
+        model.fit(X_seen, new_actions_hist, lookup_rewards(y_global, y_packed, rows, 0, batch_end, new_actions_hist),
                   warm_start = True)
     
-    ttime.append((pd.Timestamp.now() - start)/pd.Timedelta('1m'))
-    
-    return new_actions_hist
+    ttime.append((time.perf_counter() - start)/60.0) # minutes
 
 
-def run_simulation(X, y, model_dict, reward_dict, ttime_dict, 
-                   min_batch, incr_batch_pct):
-    # create batch index
+# batch boundaries only depend on the dataset size, so reuse them across model comparisons
+@lru_cache(maxsize=None)
+def batch_schedule(n_rows, min_batch, incr_batch_pct):
     n = 0
-    incrs = list()
     ns = [0]
-    nchoices = y.shape[1]
-     
-    while n<len(X):
+    
+    while n<n_rows:
         incr = max(min_batch, int(incr_batch_pct*n))
-        if n+incr>len(X):
-            incr = len(X)-n
-        incrs.append(incr)
+        if n+incr>n_rows:
+            incr = n_rows-n
         n+=incr
         ns.append(n)
+    
+    return tuple(ns)
+
+
+def run_simulation(X, y, model_dict, reward_dict, ttime_dict, 
+                   min_batch, incr_batch_pct):
+    # contiguous once up front, so every per-batch slice below is a contiguous view
+    X = np.ascontiguousarray(X)
+
+    # create batch index
+    ns = batch_schedule(len(X), min_batch, incr_batch_pct)
+    nchoices = y.shape[1]
 
     print(f'The models will be refit {len(ns)-2} times')
 
@@ -58,20 +77,38 @@ def run_simulation(X, y, model_dict, reward_dict, ttime_dict,
     for k, model in model_dict.items():
         model.fit(X=first_batch, a=action_chosen, r=rewards_received)
 
-    # these lists will keep track of which actions does each policy choose
-    action_dict = {z:action_chosen.copy() for z in model_dict.keys()}
+    # these arrays will keep track of which actions does each policy choose;
+    # preallocated for the whole dataset & filled in place batch by batch
+    action_dict = dict()
+    for z in model_dict.keys():
+        action_dict[z] = np.empty(len(X), dtype=action_chosen.dtype)
+        action_dict[z][:min_batch] = action_chosen
+
+    # row indices shared by every batch & model; slicing these is free, np.arange isn't
+    rows = np.arange(len(X))
+
+    # pack each row's labels into a bitmask when they fit in a machine word;
+    # built a column at a time to avoid an n x nchoices uint64 temporary
+    y_packed = None
+    if nchoices <= 64:
+        y_packed = np.zeros(len(y), dtype=np.uint64)
+        for j in range(nchoices):
+            y_packed |= y[:, j].astype(np.uint64) << np.uint64(j)
 
     # now running all the simulation
     for i in tqdm(range(2, len(ns)), leave=False):
         batch_st = ns[i-1]
         batch_end = ns[i]
+        # same view for every model, so estimators can share its buffer instead of copying
+        X_seen = X[:batch_end]
 
         for k in model_dict:
-            action_dict[k] = simulate_rounds(model_dict[k],
-                                                 reward_dict[k],
-                                                 action_dict[k],
-                                                 ttime_dict[k],
-                                                 X, y,
-                                                 batch_st, batch_end)
-
-    return model_dict, reward_dict, action_dict, ttime_dict, ns[2:]
+            simulate_rounds(model_dict[k],
+                            reward_dict[k],
+                            action_dict[k],
+                            ttime_dict[k],
+                            X_seen, y, rows,
+                            batch_st, batch_end,
+                            y_packed=y_packed)
+
+    return model_dict, reward_dict, action_dict, ttime_dict, list(ns[2:])